@@ -1,11 +1,22 @@
 import os
 import csv
-import time
 import re
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import heapq
+import operator
+import functools
+import itertools
 import statistics
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
-import requests
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,49 +24,361 @@ load_dotenv()
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
 RAPIDAPI_HOST = os.getenv("RAPIDAPI_HOST", "real-time-sephora-api.p.rapidapi.com")
 BASE_URL = f"https://{RAPIDAPI_HOST}"
+# Requests per minute allowed by the RapidAPI plan
+RAPIDAPI_RPM = int(os.getenv("RAPIDAPI_RPM", "500"))
 
 HEADERS = {
     "X-RapidAPI-Key": RAPIDAPI_KEY,
     "X-RapidAPI-Host": RAPIDAPI_HOST,
 }
 
+# Connection pool limits: plenty of sockets overall, but cap how many we
+# keep open against the single Sephora host.
+CONNECTOR_LIMIT = 256
+CONNECTOR_LIMIT_PER_HOST = 64
+
+# AIMD concurrency controller settings (see ConcurrencyLimiter)
+CONCURRENCY_START = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 64
+LATENCY_TARGET = 1.5  # seconds, mean over the rolling window
+LATENCY_WINDOW = 32
+
+# Retry transient failures with exponential backoff + jitter:
+# sleep RETRY_BACKOFF_FACTOR * 2**attempt + uniform(0, RETRY_BACKOFF_JITTER)
+MAX_RETRIES = 6
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_BACKOFF_JITTER = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Product-details batching: one request for many ids. Off by default because
+# it's unconfirmed whether the details endpoint accepts a comma-separated
+# productId list; when off, every product is its own request.
+DETAILS_BATCH_ENABLED = os.getenv("DETAILS_BATCH_ENABLED", "0") == "1"
+DETAILS_BATCH_SIZE = 32
+
+# Keep the full details JSON under "raw" in the parsed details (debugging only; it's large)
+DEBUG_KEEP_RAW = os.getenv("DEBUG_KEEP_RAW", "0") == "1"
+
+# Local cache of raw product-details responses so re-runs skip the API
+DETAILS_CACHE_PATH = "data/details_cache.sqlite3"
+DETAILS_CACHE_TTL = 7 * 86400  # seconds
+
+# Pause proactively once fewer than this fraction of the quota is left
+RATELIMIT_LOW_WATERMARK = 0.1
+# ...but only if the quota resets within this many seconds. The limit header
+# is usually the plan's quota for the whole billing period, so its reset can
+# be days away; we don't sleep that long, we warn (or abort once it's used up).
+RATELIMIT_MAX_PAUSE = 60
+
+# RapidAPI proxies don't agree on header names, so check the common spellings
+RATELIMIT_LIMIT_HEADERS = ("x-ratelimit-requests-limit", "x-ratelimit-limit-requests", "x-ratelimit-limit")
+RATELIMIT_REMAINING_HEADERS = ("x-ratelimit-requests-remaining", "x-ratelimit-remaining-requests", "x-ratelimit-remaining")
+RATELIMIT_RESET_HEADERS = ("x-ratelimit-requests-reset", "x-ratelimit-reset-requests", "x-ratelimit-reset")
+
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=3.05, sock_read=15)
+
 # -----------------------------
 # 1. API CALL HELPERS
 # -----------------------------
 
-def call_api(path: str, params: dict):
-    """Generic helper to call the Sephora API with error handling."""
+def make_session():
+    """Build the single aiohttp session shared by every API call in a run."""
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTOR_LIMIT,
+        limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        headers=HEADERS,
+        connector=connector,
+        timeout=REQUEST_TIMEOUT,
+    )
+
+
+def _first_number(headers, names):
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_retry_after(headers):
+    """
+    Seconds to wait according to a Retry-After header, or None if it's
+    missing or unreadable. Handles both forms RFC 9110 allows: a number of
+    seconds or an HTTP-date.
+    """
+    seconds = _first_number(headers, ("retry-after",))
+    if seconds is not None:
+        return max(0.0, seconds)
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def parse_ratelimit(headers):
+    """
+    Read the rate-limit headers from an API response.
+    Returns (limit, remaining, reset_at); any of them may be None.
+    reset_at is on the time.monotonic() clock.
+    """
+    limit = _first_number(headers, RATELIMIT_LIMIT_HEADERS)
+    remaining = _first_number(headers, RATELIMIT_REMAINING_HEADERS)
+    reset = _first_number(headers, RATELIMIT_RESET_HEADERS)
+    # RapidAPI sends "seconds until reset", not an absolute timestamp
+    reset_at = time.monotonic() + reset if reset is not None else None
+    return limit, remaining, reset_at
+
+
+class RateLimitTracker:
+    """
+    Keeps us inside the plan quota.
+
+    Combines a sliding one-minute window of `rpm` requests with the
+    limit/remaining/reset headers the API sends back, and honours Retry-After
+    on 429. The two limits are tracked separately: `rpm` is a per-minute rate,
+    `header_limit` is whatever quota the headers describe (often per month).
+    """
+
+    def __init__(self, rpm: int = RAPIDAPI_RPM):
+        self.rpm = rpm
+        self.sent = deque()
+        self.header_limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.pause_until = 0.0
+        self._warned_low = False
+
+    def _quota_delay(self, now: float):
+        if self.remaining is None:
+            return 0.0
+        exhausted = self.remaining <= 0
+        low = exhausted or (
+            self.header_limit is not None
+            and self.remaining < self.header_limit * RATELIMIT_LOW_WATERMARK
+        )
+        if not low:
+            return 0.0
+
+        until_reset = self.reset_at - now if self.reset_at is not None else None
+        if until_reset is not None and until_reset <= RATELIMIT_MAX_PAUSE:
+            return until_reset
+
+        # Reset is far away or unknown: don't sleep, but don't stay quiet either
+        when = f"resets in {until_reset / 3600:.1f}h" if until_reset is not None else "reset time unknown"
+        limit = f"{self.header_limit:.0f}" if self.header_limit is not None else "?"
+        if exhausted:
+            raise RuntimeError(f"API quota exhausted ({limit} requests), {when}")
+        if not self._warned_low:
+            print(f"  Warning: only {self.remaining:.0f}/{limit} API requests left, {when}")
+            self._warned_low = True
+        return 0.0
+
+    def _delay(self, now: float):
+        while self.sent and now - self.sent[0] >= 60:
+            self.sent.popleft()
+
+        delay = self.pause_until - now
+        if len(self.sent) >= self.rpm:
+            delay = max(delay, self.sent[0] + 60 - now)
+        return max(delay, self._quota_delay(now))
+
+    async def wait(self):
+        """Sleep until another request fits in the quota, then record it."""
+        while True:
+            now = time.monotonic()
+            delay = self._delay(now)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self.sent.append(now)
+
+    def update(self, status: int, headers):
+        """
+        Record the rate-limit state from a response.
+        Returns the Retry-After pause (seconds) now in force on a 429, else None.
+        """
+        limit, remaining, reset_at = parse_ratelimit(headers)
+        if limit:
+            self.header_limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+            self.reset_at = reset_at
+
+        if status == 429:
+            retry_after = parse_retry_after(headers)
+            if retry_after:
+                if retry_after > RATELIMIT_MAX_PAUSE:
+                    print(f"  Warning: API asked us to back off for {retry_after / 60:.0f} min (Retry-After)")
+                self.pause_until = max(self.pause_until, time.monotonic() + retry_after)
+                return retry_after
+        return None
+
+
+class ConcurrencyLimiter:
+    """
+    Adaptive cap on in-flight API calls (additive-increase, multiplicative-decrease).
+
+    While the mean latency over the last LATENCY_WINDOW calls stays under
+    LATENCY_TARGET the limit grows by 0.5 per call; a 429/5xx/timeout or a
+    full window that is too slow halves it. Responses to requests sent before
+    the last halving are ignored, so one congestion event (a burst of 429s,
+    a slow stretch) halves the limit only once. Each acquired slot also waits
+    on the rate-limit tracker before the request goes out.
+
+    acquire() returns a token that must be passed back to release().
+    """
+
+    def __init__(
+        self,
+        start: float = CONCURRENCY_START,
+        c_min: float = CONCURRENCY_MIN,
+        c_max: float = CONCURRENCY_MAX,
+        latency_target: float = LATENCY_TARGET,
+        window: int = LATENCY_WINDOW,
+        rate_limit: RateLimitTracker = None,
+    ):
+        self.c_t = float(start)
+        self.c_min = c_min
+        self.c_max = c_max
+        self.latency_target = latency_target
+        self.latencies = deque(maxlen=window)
+        self.in_flight = 0
+        # Requests are numbered as they go out; anything numbered below
+        # _decreased_at was already in flight at the last halving
+        self._next_seq = 0
+        self._decreased_at = 0
+        self.rate_limit = rate_limit or RateLimitTracker()
+        # A Condition rather than a Semaphore so the limit can be resized live
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.c_t))
+            self.in_flight += 1
+        try:
+            await self.rate_limit.wait()
+        except BaseException:
+            # Cancelled (or quota exhausted) before the request went out:
+            # give the slot back, since the caller won't call release()
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+            raise
+
+        token = self._next_seq
+        self._next_seq += 1
+        return token
+
+    async def release(self, token: int, elapsed: float, throttled: bool = False):
+        async with self._cond:
+            self.in_flight -= 1
+            # Sent before the last halving: its outcome reflects the old limit
+            if token >= self._decreased_at:
+                if throttled:
+                    self._decrease()
+                else:
+                    self.latencies.append(elapsed)
+                    mean = statistics.fmean(self.latencies)
+                    if mean <= self.latency_target:
+                        self.c_t = min(self.c_max, self.c_t + 0.5)
+                    elif len(self.latencies) == self.latencies.maxlen:
+                        # Only judge "too slow" on a full window of post-halving samples
+                        self._decrease()
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self.c_t = max(self.c_min, self.c_t * 0.5)
+        self._decreased_at = self._next_seq
+        self.latencies.clear()
+
+
+async def call_api(session: aiohttp.ClientSession, limiter: ConcurrencyLimiter, path: str, params: dict):
+    """
+    Generic helper to call the Sephora API with error handling.
+    Transient failures (RETRY_STATUSES, timeouts, connection errors) are
+    retried up to MAX_RETRIES times before giving up.
+    """
     url = f"{BASE_URL}{path}"
-    resp = requests.get(url, headers=HEADERS, params=params, timeout=15)
-    if resp.status_code != 200:
-        raise RuntimeError(f"API error {resp.status_code}: {resp.text[:200]}")
-    return resp.json()
 
+    for attempt in range(MAX_RETRIES + 1):
+        last_attempt = attempt == MAX_RETRIES
+        paused = None
 
-def fetch_products_for_search_term(search_term: str, max_pages: int = 3):
+        token = await limiter.acquire()
+        start = time.monotonic()
+        # Anything that fails before we see a status (timeouts, resets) counts as throttling
+        throttled = True
+        try:
+            async with session.get(url, params=params) as resp:
+                throttled = resp.status == 429 or resp.status >= 500
+                paused = limiter.rate_limit.update(resp.status, resp.headers)
+                if resp.status == 200:
+                    return orjson.loads(await resp.read())
+
+                text = await resp.text()
+                if resp.status not in RETRY_STATUSES or last_attempt:
+                    raise RuntimeError(f"API error {resp.status}: {text[:200]}")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if last_attempt:
+                raise
+        finally:
+            await limiter.release(token, time.monotonic() - start, throttled)
+
+        # If a 429's Retry-After set a pause, the rate-limit tracker already
+        # holds every request back for exactly that long, so don't stack a
+        # backoff on top. Unreadable or zero Retry-After still backs off.
+        if not paused:
+            await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, RETRY_BACKOFF_JITTER))
+
+
+async def fetch_products_for_search_term(session: aiohttp.ClientSession, limiter: ConcurrencyLimiter, search_term: str, max_pages: int = 3):
     """
     Fetch a list of products for a given search term.
-    Returns a list of dicts with at least product id + rating.
+    Returns a list of Product (ingredients not filled in yet).
     """
-    products = []
-
     # TODO: Adjust this to the "list/search" endpoint from docs.
     # Example: path = "/products-search" or "/products"
     LIST_ENDPOINT_PATH = "/product-search"   # <-- Replace with actual path from RapidAPI docs
 
-    for page in range(1, max_pages + 1):
+    async def fetch_page(page: int):
         params = {
             # TODO: adjust to match API docs for this endpoint
             "q": search_term,     # search query
             "page": page,
         }
-        data = call_api(LIST_ENDPOINT_PATH, params)
+        return await call_api(session, limiter, LIST_ENDPOINT_PATH, params)
 
-        # TODO: Adjust this depending on how the API returns items
-        items = data.get("products") or data.get("items") or []
-        if not items:
-            break
+    # First page tells us how many pages there are; the rest go out concurrently
+    first = await fetch_page(1)
+    # TODO: Adjust this depending on how the API returns items
+    items = first.get("products") or first.get("items") or []
+    if not items:
+        return []
+
+    # TODO: check the page-count field name in the docs; without one we just
+    # request up to max_pages and let empty pages contribute nothing
+    total_pages = first.get("totalPages") or first.get("pageCount") or max_pages
+    last_page = min(int(total_pages), max_pages)
+    rest = await asyncio.gather(*[fetch_page(page) for page in range(2, last_page + 1)])
 
+    products = []
+    for data in [first, *rest]:
+        items = data.get("products") or data.get("items") or []
         for p in items:
             # Adjust field names based on API response shape
             product_id = p.get("id") or p.get("productId")
@@ -64,111 +387,267 @@ def fetch_products_for_search_term(search_term: str, max_pages: int = 3):
             reviews_count = p.get("reviewsCount") or p.get("reviewCount")
 
             if product_id and rating is not None:
-                products.append({
-                    "id": product_id,
-                    "name": name,
-                    "rating": float(rating),
-                    "reviews_count": reviews_count,
-                })
-
-        # be nice with rate limits
-        time.sleep(0.5)
+                products.append(Product(product_id, name, float(rating), reviews_count))
 
     return products
 
 
-def fetch_product_details(product_id: str):
+# TODO: Replace with the actual product-details endpoint from docs.
+DETAILS_ENDPOINT_PATH = "/product-details"   # e.g. docs show something like this
+
+
+def _parse_details(data: dict):
+    """Pull ingredients + rating out of one product's raw details JSON."""
+    # Adjust these according to response shape
+    ingredients = data.get("ingredients") or data.get("ingredientList")
+    # Sometimes details endpoint also includes rating:
+    rating = data.get("rating") or data.get("averageRating")
+
+    details = {
+        "ingredients": ingredients,
+        "rating": rating,
+    }
+    if DEBUG_KEEP_RAW:
+        details["raw"] = data
+    return details
+
+
+async def fetch_product_details(session: aiohttp.ClientSession, limiter: ConcurrencyLimiter, product_id: str):
     """
     Fetch full details for a single product (including ingredients).
+    Returns the raw response JSON; see _parse_details.
     """
-    # TODO: Replace with the actual product-details endpoint from docs.
-    DETAILS_ENDPOINT_PATH = "/product-details"   # e.g. docs show something like this
-
     params = {
         # TODO: replace param name with what docs say (e.g. "productId")
         "productId": product_id
     }
 
-    data = call_api(DETAILS_ENDPOINT_PATH, params)
+    return await call_api(session, limiter, DETAILS_ENDPOINT_PATH, params)
 
-    # Adjust these according to response shape
-    ingredients = data.get("ingredients") or data.get("ingredientList")
-    # Sometimes details endpoint also includes rating:
-    rating = data.get("rating") or data.get("averageRating")
 
-    return {
-        "ingredients": ingredients,
-        "rating": rating,
-        "raw": data,
+async def fetch_product_details_batch(session: aiohttp.ClientSession, limiter: ConcurrencyLimiter, product_ids: list[str]):
+    """
+    Fetch details for several products in one request.
+    Returns dict: product_id -> raw product JSON. Ids missing from the response are
+    simply absent, so callers can fall back to per-id requests for them.
+    """
+    params = {
+        "productId": ",".join(str(pid) for pid in product_ids)
     }
 
+    data = await call_api(session, limiter, DETAILS_ENDPOINT_PATH, params)
+
+    # TODO: Adjust this depending on how the API returns a batch
+    items = data.get("products") or data.get("items") or []
+    found = {}
+    for item in items:
+        product_id = item.get("id") or item.get("productId")
+        if product_id is not None:
+            found[str(product_id)] = item
+    return found
+
+
+def _batched(iterable, n: int):
+    # itertools.batched only exists on Python 3.12+
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+class DetailsCache:
+    """
+    Tiny sqlite key-value store: product_id -> raw details JSON, with a TTL.
+    Lets iterative runs (e.g. tweaking the analysis) skip the API entirely.
+    Responses are stored unparsed, so fixes to _parse_details apply to
+    cached products on the next run.
+    """
+
+    def __init__(self, path: str = DETAILS_CACHE_PATH, ttl: float = DETAILS_CACHE_TTL):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " product_id TEXT PRIMARY KEY,"
+            " fetched_at REAL NOT NULL,"
+            " data BLOB NOT NULL)"
+        )
+        self._pending = 0
+
+    def get(self, product_id):
+        row = self.conn.execute(
+            "SELECT fetched_at, data FROM responses WHERE product_id = ?",
+            (str(product_id),),
+        ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return orjson.loads(row[1])
+
+    def set(self, product_id, data: dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (product_id, fetched_at, data) VALUES (?, ?, ?)",
+            (str(product_id), time.time(), orjson.dumps(data)),
+        )
+        # Commit in small groups rather than paying an fsync per product
+        self._pending += 1
+        if self._pending >= 50:
+            self.conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+async def iter_product_details(session: aiohttp.ClientSession, limiter: ConcurrencyLimiter, products, cache: DetailsCache = None):
+    """
+    Fetch details for every product concurrently (bounded by the limiter).
+    Yields a complete Product as each request completes, so callers can
+    write them out without buffering. Products found in `cache` are yielded
+    straight away; fresh raw responses are added to it.
+    """
+
+    async def fetch_one(p):
+        try:
+            data = await fetch_product_details(session, limiter, p.id)
+        except Exception as e:
+            print(f"  Error fetching details for {p.id}: {e}")
+            return p, None
+        return p, data
+
+    async def fetch_batch(batch):
+        try:
+            found = await fetch_product_details_batch(session, limiter, [p.id for p in batch])
+        except Exception as e:
+            print(f"  Error fetching details batch of {len(batch)}, retrying one by one: {e}")
+            found = {}
+
+        results = [(p, found[str(p.id)]) for p in batch if str(p.id) in found]
+        missing = [p for p in batch if str(p.id) not in found]
+        results.extend(await asyncio.gather(*[fetch_one(p) for p in missing]))
+        return results
+
+    async def fetch_single(p):
+        return [await fetch_one(p)]
+
+    def with_details(p, data):
+        details = _parse_details(data)
+        return p._replace(
+            rating=float(details["rating"]) if details["rating"] is not None else p.rating,
+            ingredients=details["ingredients"],
+        )
+
+    to_fetch = []
+    cache_hits = 0
+    for p in products:
+        data = cache.get(p.id) if cache is not None else None
+        if data is None:
+            to_fetch.append(p)
+        else:
+            cache_hits += 1
+            yield with_details(p, data)
+
+    if cache is not None:
+        print(f"  {cache_hits} products loaded from details cache")
+
+    if DETAILS_BATCH_ENABLED:
+        tasks = [asyncio.ensure_future(fetch_batch(b)) for b in _batched(to_fetch, DETAILS_BATCH_SIZE)]
+    else:
+        tasks = [asyncio.ensure_future(fetch_single(p)) for p in to_fetch]
+
+    i = 0
+    for fut in asyncio.as_completed(tasks):
+        for p, data in await fut:
+            i += 1
+            if data is not None:
+                if cache is not None:
+                    cache.set(p.id, data)
+                yield with_details(p, data)
+
+            if i % 20 == 0:
+                print(f"  Fetched details for {i} products...")
+
 # -----------------------------
 # 2. INGREDIENT ANALYSIS
 # -----------------------------
 
-def normalize_ingredient_string(ingredient_str: str):
+# One token = the text between separators (; , / ( )), trimmed so it starts
+# and ends on a letter or digit, at least 3 chars long. Anything else inside
+# a name (".", "'", "%", "&", accented letters, ...) is kept, so
+# "St. John's Wort" and "Sodium Hyaluronate 0.5%" stay whole.
+_TOKEN_RE = re.compile(r"[^\W_][^;,/()]+[^\W_]")
+
+
+@functools.lru_cache(maxsize=8192)
+def normalize_ingredient_string(ingredient_str: str) -> tuple[str, ...]:
     """
-    Turn one big ingredient string into a list of normalized ingredient tokens.
+    Turn one big ingredient string into a tuple of normalized ingredient tokens.
     Assumes ingredients are comma-separated or semicolon-separated.
+    Cached on the raw string, since products in the same line often share
+    an identical ingredient list.
     """
     if not ingredient_str:
-        return []
+        return ()
 
-    # Split on commas, semicolons, parentheses, etc.
-    parts = re.split(r"[;,/()]+", ingredient_str)
-    cleaned = []
-    for part in parts:
-        token = part.strip().lower()
-        # Remove extra spaces/punctuation at the ends
-        token = re.sub(r"^[^a-z0-9]+|[^a-z0-9]+$", "", token)
-        if len(token) > 2:
-            cleaned.append(token)
-    return cleaned
+    # Single regex pass extracts the tokens already trimmed. Interning means
+    # "water", "glycerin", ... share one object across every product, and the
+    # aggregator's dict lookups hit the identity fast path.
+    return tuple(sys.intern(token) for token in _TOKEN_RE.findall(ingredient_str.lower()))
 
 
-def build_ingredient_stats(products_with_details):
-    """
-    products_with_details: list of dicts with keys:
-      - id, name, rating, ingredients (string)
-    Returns dict: ingredient -> stats
-    """
-    ingredient_to_ratings = defaultdict(list)
+# One product row; ingredients stays None until the details stage fills it in.
+# Field order is also the column order of products_raw.csv.
+Product = namedtuple("Product", "id name rating reviews_count ingredients", defaults=(None,))
 
-    for p in products_with_details:
-        rating = p.get("rating")
-        ingredient_str = p.get("ingredients")
-        if rating is None or not ingredient_str:
-            continue
+# One row of ingredient_report.csv, in column order
+IngredientStat = namedtuple("IngredientStat", "ingredient product_count avg_rating_with_ingredient")
 
-        ingredients = normalize_ingredient_string(ingredient_str)
-        unique_ings = set(ingredients)
 
-        for ing in unique_ings:
-            ingredient_to_ratings[ing].append(rating)
-
-    # Compute stats
-    stats = []
-    for ingredient, ratings in ingredient_to_ratings.items():
-        if len(ratings) < 5:
-            # Ignore ingredients that only appear in a few products
-            continue
-
-        avg_rating = statistics.mean(ratings)
-        stats.append({
-            "ingredient": ingredient,
-            "product_count": len(ratings),
-            "avg_rating_with_ingredient": round(avg_rating, 3),
-        })
+class IngredientStats:
+    """
+    Running per-ingredient rating aggregate, fed one product at a time so
+    the details stage never has to keep products around.
+    """
 
-    # Sort ingredients by avg_rating desc then by product_count desc
-    stats.sort(key=lambda x: (x["avg_rating_with_ingredient"], x["product_count"]), reverse=True)
-    return stats
+    def __init__(self):
+        # ingredient -> [product_count, rating_sum]; no need to keep every rating
+        self.agg = defaultdict(lambda: [0, 0.0])
+
+    def add(self, p: Product):
+        """p: Product with rating and ingredients (string) filled in."""
+        if p.rating is None or not p.ingredients:
+            return
+
+        for ing in set(normalize_ingredient_string(p.ingredients)):
+            a = self.agg[ing]
+            a[0] += 1
+            a[1] += p.rating
+
+    def report(self, top_k: int = None):
+        """
+        top_k: if set, only keep the top_k best-rated ingredients
+        Returns list of IngredientStat
+        """
+        stats = []
+        for ingredient, (count, total) in self.agg.items():
+            if count < 5:
+                # Ignore ingredients that only appear in a few products
+                continue
+
+            stats.append(IngredientStat(ingredient, count, round(total / count, 3)))
+
+        # Sort ingredients by avg_rating desc then by product_count desc
+        sort_key = operator.attrgetter("avg_rating_with_ingredient", "product_count")
+        if top_k is not None:
+            # O(N log K) instead of sorting the whole list
+            return heapq.nlargest(top_k, stats, key=sort_key)
+        stats.sort(key=sort_key, reverse=True)
+        return stats
 
 # -----------------------------
 # 3. MAIN PIPELINE
 # -----------------------------
 
-def main():
+async def main():
     os.makedirs("data", exist_ok=True)
 
     search_terms = [
@@ -178,74 +657,56 @@ def main():
         "foundation",
     ]
 
-    print("Fetching product lists...")
-    all_products = []
-
-    for term in search_terms:
-        prods = fetch_products_for_search_term(term, max_pages=3)
-        print(f"  {term}: fetched {len(prods)} products")
-        all_products.extend(prods)
-
-    # Deduplicate by id
-    seen = {}
-    for p in all_products:
-        seen[p["id"]] = p  # last one wins
-    unique_products = list(seen.values())
-    print(f"Total unique products: {len(unique_products)}")
-
-    # Fetch details (ingredients) for each product
-    products_with_details = []
-    print("Fetching product details (ingredients)...")
-
-    for i, p in enumerate(unique_products, start=1):
+    limiter = ConcurrencyLimiter()
+
+    async with make_session() as session:
+        print("Fetching product lists...")
+        # Deduplicate by id as we go (first one wins)
+        unique_products: dict[str, Product] = {}
+
+        results = await asyncio.gather(*[
+            fetch_products_for_search_term(session, limiter, term, max_pages=3)
+            for term in search_terms
+        ])
+        for term, prods in zip(search_terms, results):
+            print(f"  {term}: fetched {len(prods)} products")
+            for p in prods:
+                unique_products.setdefault(p.id, p)
+
+        print(f"Total unique products: {len(unique_products)}")
+
+        # Fetch details (ingredients) for each product. Each one is written to
+        # the raw CSV and folded into the ingredient stats as it arrives, then
+        # dropped, so memory stays at O(unique ingredients).
+        print("Fetching product details (ingredients)...")
+        raw_csv_path = "data/products_raw.csv"
+        details_count = 0
+        ingredient_agg = IngredientStats()
+        cache = DetailsCache()
         try:
-            details = fetch_product_details(p["id"])
-        except Exception as e:
-            print(f"  Error fetching details for {p['id']}: {e}")
-            continue
-
-        product_data = {
-            "id": p["id"],
-            "name": p["name"],
-            "rating": details["rating"] if details["rating"] is not None else p["rating"],
-            "reviews_count": p["reviews_count"],
-            "ingredients": details["ingredients"],
-        }
-        products_with_details.append(product_data)
-
-        if i % 20 == 0:
-            print(f"  Fetched details for {i} products...")
-        time.sleep(0.4)  # avoid hammering the API
-
-    print(f"Got details for {len(products_with_details)} products")
-
-    # Save raw product data (optional)
-    raw_csv_path = "data/products_raw.csv"
-    with open(raw_csv_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=["id", "name", "rating", "reviews_count", "ingredients"],
-        )
-        writer.writeheader()
-        for p in products_with_details:
-            writer.writerow(p)
-
+            with open(raw_csv_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(Product._fields)
+                async for product_data in iter_product_details(session, limiter, unique_products.values(), cache):
+                    writer.writerow(product_data)
+                    ingredient_agg.add(product_data)
+                    details_count += 1
+        finally:
+            cache.close()
+
+    print(f"Got details for {details_count} products")
     print(f"Saved raw product data to {raw_csv_path}")
 
     # Build ingredient stats
     print("Analyzing ingredient correlations with rating...")
-    ingredient_stats = build_ingredient_stats(products_with_details)
+    ingredient_stats = ingredient_agg.report()
 
     # Write ingredient report
     report_path = "data/ingredient_report.csv"
     with open(report_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=["ingredient", "product_count", "avg_rating_with_ingredient"],
-        )
-        writer.writeheader()
-        for row in ingredient_stats:
-            writer.writerow(row)
+        writer = csv.writer(f)
+        writer.writerow(IngredientStat._fields)
+        writer.writerows(ingredient_stats)
 
     print(f"Ingredient report written to {report_path}")
     print("Done ✨")
@@ -254,4 +715,4 @@ def main():
 if __name__ == "__main__":
     if not RAPIDAPI_KEY:
         raise SystemExit("Missing RAPIDAPI_KEY in .env")
-    main()
+    asyncio.run(main())